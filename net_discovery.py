@@ -1,13 +1,19 @@
 import yaml
-from netmiko import ConnectHandler
+from netmiko import ConnectHandler, redispatch
 from netmiko.ssh_autodetect import SSHDetect
+from netmiko.exceptions import ReadTimeout
 import os
 import sys
 import logging
 import csv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import queue
 import re
+import time
+import itertools
+import functools
+import socket
 from tabulate import tabulate
 
 # VENDOR_COMMANDS and PLATFORM_MAPPING same as before
@@ -60,6 +66,11 @@ PLATFORM_MAPPING = {
 }
 
 
+# Compiled once; the IPv4 pattern runs on bytes so the regex engine skips Unicode handling
+_IPV4_RE = re.compile(rb'\b(?:\d{1,3}\.){3}\d{1,3}\b', re.ASCII)
+_JUNOS_IF_RE = re.compile(r'(?m)^[ \t]*(?!Local Interface)(\S+)')
+
+
 def setup_logger(debug=False):
     level = logging.DEBUG if debug else logging.INFO
     logging.basicConfig(
@@ -67,6 +78,11 @@ def setup_logger(debug=False):
         level=level
     )
 
+# Share resolver results across workers; failures are not cached by lru_cache
+def install_resolver_cache(maxsize=4096):
+    if not hasattr(socket.getaddrinfo, 'cache_info'):
+        socket.getaddrinfo = functools.lru_cache(maxsize=maxsize)(socket.getaddrinfo)
+
 def load_credentials(yaml_file):
     try:
         with open(yaml_file) as f:
@@ -80,6 +96,18 @@ def load_credentials(yaml_file):
 def get_device_cred(ip, creds):
     return creds.get('devices', {}).get(ip, creds.get('default', {}))
 
+# Disable Nagle and enable keepalives on the TCP socket under Netmiko's SSH channel.
+# Buffer sizes are left alone: setting SO_RCVBUF/SO_SNDBUF disables kernel autotuning.
+def _tune_socket(net_connect):
+    try:
+        sock = net_connect.remote_conn.get_transport().sock
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    except (AttributeError, OSError) as e:
+        logging.debug(f"Could not tune socket for {net_connect.host}: {e}")
+
 def ssh_connect(ip, creds, device_type):
     device_cred = get_device_cred(ip, creds)
     if not device_cred:
@@ -109,6 +137,7 @@ def ssh_connect(ip, creds, device_type):
 
     try:
         net_connect = ConnectHandler(**device_params)
+        _tune_socket(net_connect)
         if device_params['secret']:
             net_connect.enable()
         logging.debug(f"SSH connection established to {ip} ({device_type})")
@@ -117,11 +146,21 @@ def ssh_connect(ip, creds, device_type):
         logging.error(f"Failed to connect to {ip} ({device_type}): {e}")
         return None
 
+# SSHDetect that keeps its session open so discovery can reuse it
+class ReusableSSHDetect(SSHDetect):
+    def autodetect(self):
+        # autodetect() disconnects on every return path; suppress that here
+        self.connection.disconnect = lambda: None
+        try:
+            return super().autodetect()
+        finally:
+            del self.connection.disconnect
+
 def detect_device_type(ip, creds):
     device_cred = get_device_cred(ip, creds)
     if not device_cred:
         logging.error(f"No credentials found for device {ip}")
-        return None
+        return None, None
 
     base_params = {
         'device_type': 'autodetect',
@@ -129,159 +168,339 @@ def detect_device_type(ip, creds):
         'username': device_cred.get('username', ''),
         'password': device_cred.get('password', ''),
         'port': device_cred.get('optional_args', {}).get('port', 22),
+        'secret': device_cred.get('secret', ''),
         'timeout': 10,
     }
     try:
-        guesser = SSHDetect(**base_params)
+        guesser = ReusableSSHDetect(**base_params)
+        _tune_socket(guesser.connection)
         best_match = guesser.autodetect()
         logging.info(f"Detected device type for {ip}: {best_match}")
-        return best_match
     except Exception as e:
         logging.error(f"Failed to autodetect device type for {ip}: {e}")
-        return None
+        return None, None
+
+    net_connect = guesser.connection
+    if best_match not in VENDOR_COMMANDS:
+        net_connect.disconnect()
+        return best_match, None
+
+    # Switch the autodetect session over to the real platform driver
+    try:
+        redispatch(net_connect, device_type=best_match)
+        # SSHDetect forces global_cmd_verify=False; restore the default so reused
+        # sessions verify command echo just like ssh_connect() sessions do
+        net_connect.global_cmd_verify = None
+        if base_params['secret']:
+            net_connect.enable()
+        logging.debug(f"Reusing autodetect session to {ip} ({best_match})")
+        return best_match, net_connect
+    except Exception as e:
+        logging.debug(f"Could not reuse autodetect session to {ip}, reconnecting: {e}")
+        net_connect.disconnect()
+        return best_match, None
 
 # Extract all IP addresses from LLDP command output
 def extract_all_ips(output):
-    return set(re.findall(r'\b(?:\d{1,3}\.){3}\d{1,3}\b', output))
+    if isinstance(output, str):
+        output = output.encode('ascii', 'replace')
+    return {ip.decode() for ip in _IPV4_RE.findall(output)}
+
+# Scan command output for IPs as it arrives instead of buffering the whole response.
+# Trailing digits/dots (and a possible partial prompt) are carried into the next read
+# so an IP split across reads isn't matched as a shorter address, and prompts are
+# blanked out so one like 'admin@10.0.0.1>' isn't reported as a neighbor.
+# Reading stops once a prompt follows each command; ReadTimeout is raised otherwise.
+def stream_neighbor_ips(net_connect, cmds, prompt, read_timeout=10):
+    net_connect.write_channel(net_connect.RETURN.join(cmds) + net_connect.RETURN)
+    ips = set()
+    carry = ''
+    prompt_tail = ''
+    prompts_seen = 0
+    last_data = time.monotonic()
+    while prompts_seen < len(cmds):
+        chunk = net_connect.read_channel()
+        if not chunk:
+            if time.monotonic() - last_data > read_timeout:
+                raise ReadTimeout(f"Timed out waiting for '{prompt}' after {cmds}")
+            time.sleep(0.1)
+            continue
+        last_data = time.monotonic()
+
+        window = prompt_tail + chunk
+        prompts_seen += window.count(prompt)
+        prompt_tail = window[-(len(prompt) - 1):] if len(prompt) > 1 else ''
+
+        buf = (carry + chunk).replace(prompt, ' ')
+        limit = max(len(buf) - len(prompt) + 1, 0)
+        cut = max(len(buf[:limit].rstrip('0123456789.')) - 1, 0)
+        if limit - cut > 64:
+            cut = limit
+        ips.update(extract_all_ips(buf[:cut + 1]))
+        carry = buf[cut:]
+    ips.update(extract_all_ips(carry))
+    return ips
 
 # Thread-safe shared state
-visited_lock = threading.Lock()
-results_lock = threading.Lock()
+_state_lock = threading.RLock()
 visited_global = set()
 results_global = []
 
+# Results are reported as devices are discovered. File and terminal I/O happen under
+# _output_lock so a slow disk or stdout never holds up _state_lock.
+_output_lock = threading.Lock()
+CSV_FIELDS = ['ip', 'device_type', 'hostname']
+csv_filename = None
+csv_stream = None
+result_callback = None
+
+# The CSV file is only created once the first device is discovered
+def open_csv_stream(filename):
+    global csv_filename
+    with _output_lock:
+        csv_filename = filename
+
+def _write_csv_row(entry):
+    # Called with _output_lock held
+    global csv_filename, csv_stream
+    if csv_stream is None:
+        if not csv_filename:
+            return
+        try:
+            f = open(csv_filename, 'w', newline='')
+        except Exception as e:
+            logging.error(f"Failed to write CSV file '{csv_filename}': {e}")
+            csv_filename = None
+            return
+        try:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+        except Exception as e:
+            f.close()
+            logging.error(f"Failed to write CSV file '{csv_filename}': {e}")
+            csv_filename = None
+            return
+        csv_stream = (f, writer)
+        logging.info(f"Exporting discovered devices to {csv_filename}")
+
+    f, writer = csv_stream
+    try:
+        writer.writerow(entry)
+        f.flush()
+    except Exception as e:
+        logging.error(f"Failed to write CSV row for {entry['ip']}: {e}")
+
+def close_csv_stream():
+    global csv_filename, csv_stream
+    with _output_lock:
+        if csv_stream:
+            csv_stream[0].close()
+        elif csv_filename:
+            logging.warning("No devices discovered, skipping CSV export")
+        csv_filename, csv_stream = None, None
+
+def format_result_row(entry):
+    return f"{entry['ip']:15}  {entry['device_type']:20}  {entry['hostname']}"
+
+def record_result(entry):
+    with _state_lock:
+        results_global.append(entry)
+    with _output_lock:
+        if result_callback:
+            try:
+                result_callback(entry)
+            except Exception as e:
+                logging.error(f"Result callback failed for {entry['ip']}: {e}")
+        _write_csv_row(entry)
+
 def discover_single(ip, creds, templates_path):
-    with visited_lock:
+    # Lock-free pre-check; set membership is atomic, the locked test-and-set is authoritative
+    if ip in visited_global:
+        logging.debug(f"{ip} already visited, skipping")
+        return set(), []
+    with _state_lock:
         if ip in visited_global:
             logging.debug(f"{ip} already visited, skipping")
             return set(), []
+        visited_global.add(ip)
 
     logging.info(f"Discovering {ip}")
 
-    device_type = detect_device_type(ip, creds)
+    # Skip autodetect when the credentials file already pins the platform
+    device_type = get_device_cred(ip, creds).get('device_type')
+    net_connect = None
+    if device_type:
+        logging.debug(f"Using device type '{device_type}' from credentials for {ip}")
+    else:
+        device_type, net_connect = detect_device_type(ip, creds)
     if not device_type or device_type not in VENDOR_COMMANDS:
         logging.warning(f"Skipping {ip}: unsupported or undetected device type '{device_type}'")
-        with visited_lock:
-            visited_global.add(ip)
         return set(), []
 
-    net_connect = ssh_connect(ip, creds, device_type)
+    # Reuse the autodetect session when there is one
+    if not net_connect:
+        net_connect = ssh_connect(ip, creds, device_type)
     if not net_connect:
-        with visited_lock:
-            visited_global.add(ip)
         return set(), []
 
-    hostname = net_connect.find_prompt().strip("#>").strip()
+    try:
+        prompt = net_connect.find_prompt()
+        hostname = prompt.strip("#>").strip()
 
-    with visited_lock:
-        visited_global.add(ip)
-    with results_lock:
-        results_global.append({
+        record_result({
             'ip': ip,
             'device_type': device_type,
             'hostname': hostname,
         })
 
-    commands = VENDOR_COMMANDS[device_type]
-    neighbor_ips = set()
-
-    for proto in ['cdp', 'lldp']:
-        cmd = commands.get(proto)
-        if not cmd:
-            continue
-
-        if device_type in ('juniper', 'juniper_junos') and proto == 'lldp':
-            output = net_connect.send_command("show lldp neighbors detail")
-            if "syntax error" in output.lower():
-                logging.warning(f"LLDP detail not supported on {ip}, falling back to per-interface mode.")
-                try:
-                    summary_output = net_connect.send_command("show lldp neighbors")
-                    interfaces = parse_juniper_lldp_interfaces(summary_output)
-                    for iface in interfaces:
-                        detail_output = net_connect.send_command(f"show lldp neighbors interface {iface}")
-                        ips = extract_all_ips(detail_output)
-                        neighbor_ips.update(ips)
-                except Exception as e:
-                    logging.error(f"Fallback LLDP per-interface failed on {ip}: {e}")
-            else:
-                ips = extract_all_ips(output)
-                neighbor_ips.update(ips)
-            continue
+        commands = VENDOR_COMMANDS[device_type]
+        if device_type in ('juniper', 'juniper_junos'):
+            return juniper_neighbor_ips(net_connect, ip, commands['lldp']), [(ip, device_type)]
 
-    # Default for all other cases
+        # Default for all other cases: send CDP and LLDP in one round trip,
+        # IP extraction doesn't care where one output ends and the next begins
+        cmds = [c for c in (commands['cdp'], commands['lldp']) if c]
+        neighbor_ips = set()
         try:
-            output = net_connect.send_command(cmd)
-            ips = extract_all_ips(output)
-            neighbor_ips.update(ips)
+            neighbor_ips.update(stream_neighbor_ips(net_connect, cmds, prompt))
         except Exception as e:
-            logging.error(f"Failed to run '{cmd}' on {ip}: {e}")
-            continue
+            logging.error(f"Failed to run {cmds} on {ip}: {e}")
+
+        return neighbor_ips, [(ip, device_type)]
+    finally:
+        net_connect.disconnect()
 
-    return neighbor_ips, [(ip, device_type)]
+# Juniper: LLDP detail in one command, per-interface only on releases without it
+def juniper_neighbor_ips(net_connect, ip, cmd):
+    try:
+        output = net_connect.send_command(cmd)
+    except Exception as e:
+        logging.error(f"Failed to run '{cmd}' on {ip}: {e}")
+        return set()
+    if "syntax error" not in output.lower():
+        return extract_all_ips(output)
+
+    logging.warning(f"LLDP detail not supported on {ip}, falling back to per-interface mode.")
+    neighbor_ips = set()
+    try:
+        summary_output = net_connect.send_command("show lldp neighbors")
+        for iface in parse_juniper_lldp_interfaces(summary_output):
+            detail_output = net_connect.send_command(f"show lldp neighbors interface {iface}")
+            neighbor_ips.update(extract_all_ips(detail_output))
+    except Exception as e:
+        logging.error(f"Fallback LLDP per-interface failed on {ip}: {e}")
+    return neighbor_ips
 
 def parse_juniper_lldp_interfaces(output):
-    interfaces = set()
-    for line in output.strip().splitlines():
-        # Skip header or blank lines
-        if line.startswith("Local Interface") or not line.strip():
-            continue
-        parts = line.split()
-        if len(parts) >= 1:
-            interfaces.add(parts[0])
-    return interfaces
-
-def concurrent_discover(seed_ip, creds, templates_path, max_depth, max_workers=10):
-    to_visit = set([seed_ip])
-    current_depth = 0
-
-    while current_depth <= max_depth and to_visit:
-        logging.info(f"Starting discovery depth {current_depth} with {len(to_visit)} device(s)")
-        futures = []
-        next_to_visit = set()
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for ip in to_visit:
-                futures.append(executor.submit(discover_single, ip, creds, templates_path))
-
-            for future in as_completed(futures):
-                try:
-                    neighbor_ips, _ = future.result()
-                    new_ips = neighbor_ips - visited_global
-                    next_to_visit.update(new_ips)
-                except Exception as e:
-                    logging.error(f"Error in thread during discovery: {e}")
-
-        to_visit = next_to_visit
-        current_depth += 1
+    # First column of every line except the header and blank lines
+    return set(_JUNOS_IF_RE.findall(output))
 
-    return visited_global, results_global
+# Round-robin worker threads over the CPUs this process may run on
+_cpu_cycle_lock = threading.Lock()
+_cpu_cycle = itertools.cycle(sorted(os.sched_getaffinity(0))) if hasattr(os, 'sched_getaffinity') else None
 
-def save_to_csv(results, filename="discovered_devices.csv"):
-    if not results:
-        logging.warning("No devices discovered, skipping CSV export")
+def _pin_thread():
+    if _cpu_cycle is None or not hasattr(os, 'sched_setaffinity'):
         return
-
-    keys = results[0].keys()
+    with _cpu_cycle_lock:
+        core = next(_cpu_cycle)
     try:
-        with open(filename, 'w', newline='') as f:
-            dict_writer = csv.DictWriter(f, fieldnames=keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(results)
-        logging.info(f"Exported discovered devices to {filename}")
-    except Exception as e:
-        logging.error(f"Failed to write CSV file '{filename}': {e}")
+        os.sched_setaffinity(0, {core})
+        logging.debug(f"Pinned {threading.current_thread().name} to CPU {core}")
+    except OSError as e:
+        logging.debug(f"Could not pin {threading.current_thread().name} to CPU {core}: {e}")
+
+def concurrent_discover(seed_ip, creds, templates_path, max_depth, max_workers=32,
+                        csv_filename="discovered_devices.csv", on_result=None):
+    global result_callback
+    result_callback = on_result
+    # One long-lived pool; each finished device queues its neighbors at depth + 1.
+    # scheduled holds the shortest depth each IP has been reached at, so a shorter
+    # path found later replaces a deeper one that got there first. Finished devices
+    # keep their neighbor set so they can be re-expanded without reconnecting.
+    work = queue.Queue()
+    work.put(seed_ip)
+    scheduled = {seed_ip: 0}
+    submitted = set()
+    neighbors = {}
+    in_flight = 0
+    done = threading.Condition(_state_lock)
+
+    def expand(ip):
+        # Called with done held
+        depth = scheduled[ip]
+        if depth >= max_depth:
+            return
+        for new_ip in neighbors[ip]:
+            if depth + 1 < scheduled.get(new_ip, max_depth + 1):
+                scheduled[new_ip] = depth + 1
+                if new_ip in neighbors:
+                    expand(new_ip)
+                elif new_ip not in submitted:
+                    work.put(new_ip)
+
+    def on_done(future, ip):
+        nonlocal in_flight
+        try:
+            neighbor_ips, _ = future.result()
+        except Exception as e:
+            logging.error(f"Error in thread during discovery: {e}")
+            neighbor_ips = set()
+        with done:
+            neighbors[ip] = neighbor_ips
+            expand(ip)
+            in_flight -= 1
+            done.notify()
+
+    open_csv_stream(csv_filename)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="netdisc",
+                                initializer=_pin_thread) as executor:
+            while True:
+                with done:
+                    while work.empty() and in_flight:
+                        done.wait()
+                    if work.empty():
+                        break
+                    ip = work.get()
+                    if ip in submitted:
+                        continue
+                    submitted.add(ip)
+                    in_flight += 1
+                    logging.debug(f"Queueing {ip} at depth {scheduled[ip]}")
+                future = executor.submit(discover_single, ip, creds, templates_path)
+                future.add_done_callback(lambda f, ip=ip: on_done(f, ip))
+    finally:
+        close_csv_stream()
+        result_callback = None
+
+    return visited_global, results_global
 
 if __name__ == "__main__":
+    usage = "Usage: python net_discover.py <seed_ip> <credentials.yaml> <depth> [--debug] [--workers N] [--final-table]"
     if len(sys.argv) < 4:
-        print("Usage: python net_discover.py <seed_ip> <credentials.yaml> <depth> [--debug]")
+        print(usage)
         sys.exit(1)
 
     seed_ip = sys.argv[1]
     cred_file = sys.argv[2]
     max_depth = int(sys.argv[3])
     debug = '--debug' in sys.argv
+    final_table = '--final-table' in sys.argv
+    workers = 32
+    if '--workers' in sys.argv:
+        value = sys.argv[sys.argv.index('--workers') + 1:][:1]
+        try:
+            workers = int(value[0]) if value else 0
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            print("--workers needs a positive integer")
+            print(usage)
+            sys.exit(1)
 
     setup_logger(debug)
+    install_resolver_cache()
 
     ntc_templates_path = os.path.expanduser("~/ntc-templates/ntc_templates/templates")
     if not os.path.isdir(ntc_templates_path):
@@ -289,9 +508,13 @@ if __name__ == "__main__":
 
     creds = load_credentials(cred_file)
 
-    visited_ips, results = concurrent_discover(seed_ip, creds, ntc_templates_path, max_depth)
-
     print("\nDiscovered devices:")
-    print(tabulate(results, headers="keys", tablefmt="pretty"))
+    print(format_result_row({'ip': 'ip', 'device_type': 'device_type', 'hostname': 'hostname'}), flush=True)
+
+    visited_ips, results = concurrent_discover(
+        seed_ip, creds, ntc_templates_path, max_depth, workers,
+        on_result=lambda entry: print(format_result_row(entry), flush=True))
 
-    save_to_csv(results)
+    # Full table needs every row up front; only worth it for small runs
+    if final_table:
+        print(tabulate(results, headers="keys", tablefmt="pretty"))